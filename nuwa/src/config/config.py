@@ -72,6 +72,25 @@ NPC_MEMORY_CONFIG = {
     "db_dir": "./npc_memory.db",
 }
 
+ENGINE_CONFIG = {
+    # 处理数据包的工作线程数，也就是同时处理的数据包上限
+    "max_workers": 8,
+    # 等待处理的完整数据包队列上限，队列满时暂停读取socket(背压)
+    "max_pending_packets": 256,
+    # 等待的数据包超过这个数量时，丢弃等待超过background_ttl秒的后台数据包(wake_up/action_done)
+    "shed_queue_depth": 128,
+    "background_ttl": 30.0,
+    # 未收齐分片的消息保留秒数，超时视为分片丢失
+    "reassembly_ttl": 10.0,
+    # 分片缓存的总字节上限
+    "reassembly_max_bytes": 16 * 1024 * 1024,
+    # 协商压缩后，超过这个字节数的消息使用zlib压缩(例如长剧本)
+    "compress_threshold": 4096,
+    "compress_level": 6,
+    # 解压后消息的字节上限
+    "max_message_bytes": 16 * 1024 * 1024,
+}
+
 # assert dim of hf model == dim of pinecone index
 assert (
     PINECONE_CONFIG["pinecone_index_dim"] == NPC_MEMORY_CONFIG["hf_dim"]
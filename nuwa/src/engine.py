@@ -10,8 +10,8 @@ from concurrent.futures import ThreadPoolExecutor
 import datetime
 import json
 import socket
+import threading
 import traceback
-import uuid
 from typing import List, Dict, Any, Tuple
 from functools import partial
 
@@ -22,7 +22,6 @@ import colorama
 import openai
 #import zhipuai
 from pathlib import Path
-import sys
 
 from nuwa.src.npc.action import ActionItem
 from nuwa.src.npc.npc import NPC
@@ -32,15 +31,52 @@ from nuwa.src.npc.conversation import Conversation
 
 colorama.init()
 from colorama import Fore, Style
-from nuwa.src.config.config import NPC_MEMORY_CONFIG
+from nuwa.src.config.config import NPC_MEMORY_CONFIG, ENGINE_CONFIG
 from nuwa.src.utils.engine_logger import EngineLogger
+from nuwa.src.utils.receive_utils import ReassemblyBuffer, decompress_payload
+from nuwa.src.utils.send_utils import send_data, unpack_packet, FRAMING_TEXT, FRAMING_BINARY, COMPRESSION_ZLIB
+from nuwa.src.utils.codec import decode_packet, PacketError
+from nuwa.src.utils.scheduler import PacketScheduler, PRIORITY_PLAYER, PRIORITY_CONVERSATION, PRIORITY_BACKGROUND
 from nuwa.src.utils.embedding import LocalEmbedding, HuggingFaceEmbedding, BaseEmbeddingModel
 
+class EngineProtocol(asyncio.DatagramProtocol):
+    """
+    引擎的UDP接收协议，数据包到达时由事件循环回调，交给NPCEngine重组和分发
+    """
+    def __init__(self, engine: "NPCEngine"):
+        self.engine = engine
+
+    def datagram_received(self, data: bytes, addr):
+        self.engine.datagram_received(data, addr)
+
+    def error_received(self, exc: Exception):
+        self.engine.logger.error(f"udp error: {exc}")
+
+    def connection_lost(self, exc):
+        # socket关闭后结束listen
+        if not self.engine.closed.done():
+            self.engine.closed.set_result(None)
+
+
 class NPCEngine:
     """
     项目的核心入口类，扮演着一个Router的角色，负责接受相应的包并出发对应函数返回结果给游戏。
     engine的实现是基于socket UDP的，并发处理主要靠coroutine实现。
     """
+    # 数据包的延迟等级，玩家正在等待的请求最先处理，后台NPC的行为规划最后处理
+    FUNC_PRIORITY = {
+        "init": PRIORITY_PLAYER,
+        "close": PRIORITY_PLAYER,
+        "talk2npc": PRIORITY_PLAYER,
+        "create_conversation": PRIORITY_CONVERSATION,
+        "re_create_conversation": PRIORITY_CONVERSATION,
+        "confirm_conversation_line": PRIORITY_CONVERSATION,
+        "wake_up": PRIORITY_BACKGROUND,
+        "action_done": PRIORITY_BACKGROUND,
+    }
+    # 同一个NPC有更新的数据包到达时，这些数据包的LLM规划结果已经过时，可以跳过
+    COALESCE_FUNCS = {"wake_up", "action_done"}
+
     def __init__(
         self,
         project_root_path: Path,
@@ -113,8 +149,30 @@ class NPCEngine:
         self.npc_dict = {}
         self.npc_index_dict = {}
         self.action_dict = {}
+        # 未接收完整的UDP分片
+        self.reassembly = ReassemblyBuffer(ttl=ENGINE_CONFIG["reassembly_ttl"],
+                                           max_bytes=ENGINE_CONFIG["reassembly_max_bytes"])
+        # 接收相关的状态，在listen中由事件循环使用
+        self.loop = asyncio.get_event_loop()
+        # 同一个NPC的数据包按顺序处理，不同NPC之间并行
+        self.scheduler = PacketScheduler(max_pending=ENGINE_CONFIG["max_pending_packets"],
+                                         shed_depth=ENGINE_CONFIG["shed_queue_depth"],
+                                         background_ttl=ENGINE_CONFIG["background_ttl"])
+        self.current_job = threading.local()  # 工作线程正在处理的数据包
+        self.stats_lock = threading.Lock()
+        self.coalesce_stats = {
+            "superseded": 0,  # 被同一个NPC更新的数据包取代的数据包数
+            "llm_calls_saved": 0,  # 因此省下的LLM请求数
+        }
+        self.reading_paused = False
+        self.closed = self.loop.create_future()
+        self.transport = None
+        # 接收socket交给asyncio后会变为非阻塞，工作线程使用单独的阻塞socket发送数据
         self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)  # 使用IPv6地址
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 添加这一行
+        self.send_sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.framing = FRAMING_TEXT  # 发送给游戏的分片头部格式，init时可以协商为二进制头部
+        self.compression = None  # 发送给游戏的消息压缩方式，init时可以协商为zlib(需要二进制头部)
         print(
             Fore.GREEN
             + f"listening on [::]:{self.engine_port}, sending data to {self.game_url}:{self.game_port}, using general llm model {self.model}, action llm model  {self.action_model}"
@@ -135,71 +193,173 @@ class NPCEngine:
         self.logger.info("using local embedding model")
         self.logger.info("initialized NPC-ENGINE")
         try:
-            self.loop = asyncio.get_event_loop()
             self.loop.run_until_complete(self.listen())
         except KeyboardInterrupt:
             self.logger.info("Detected Ctrl+C, exiting...")
             self.logger.info("Exiting...")
-            self.sock.close()
+            if self.transport is not None:
+                self.transport.close()
+        self.send_sock.close()
 
-    async def listen(self, buffer_size=400000):
+    async def listen(self):
         """
         监听端口，接收游戏发送的数据,并根据数据调用相应的函数
+        接收基于asyncio.DatagramProtocol，数据包由事件循环回调处理，不会阻塞事件循环；
+        完整的数据包放入有界的调度器，由固定数量的worker交给线程池执行，队列满时暂停读取socket。
+        同一个NPC的数据包逐个执行，不同NPC的数据包最多max_workers个并行执行；
+        玩家相关的数据包优先于对话，对话优先于后台的wake_up/action_done。
         :return:
         """
         print(f"listening on [::]:{self.engine_port}")
         self.logger.info(f"listening on [::]:{self.engine_port}")
-        buffer = {}
-        with ThreadPoolExecutor() as pool:
-            while True:
-                data, addr = self.sock.recvfrom(buffer_size)
-                # 解析UDP数据包头部
-                msg_id, packet_no, total_packets, pack = data.split(b"@", 3)
-                packet_no = int(packet_no)
-                total_packets = int(total_packets)
-                # 缓存数据包
-                if msg_id not in buffer:
-                    buffer[msg_id] = [b""] * total_packets
-                buffer[msg_id][packet_no - 1] = pack
-                # 检查是否所有数据包都已接收
-                if not any(part == b"" for part in buffer[msg_id]):
-                    # 重组消息
-                    msg_str = b"".join(buffer[msg_id]).decode("utf-8")
-                    json_data = json.loads(msg_str)
-                    self.logger.debug(f"received packet {json_data}")
-
-                    try:
-                        # 按照完整数据包的func字段调用相应的函数
-                        if "func" in json_data.keys():
-                            func_name = json_data["func"]
-                            if hasattr(self, func_name):
-                                func = getattr(self, func_name)
-                                func_partial = partial(func, json_data)
-                                self.loop.run_in_executor(pool, func_partial)
-                            if "init" in json_data["func"]:
-                                self.logger.info(f"[NPC-ENGINE]<UDP INIT>: {json_data}")
-                            if "create_conversation" in json_data["func"]:
-                                self.logger.info(f"[NPC-ENGINE]<create_conversation>: {json_data}")
-                            if "confirm_conversation" in json_data["func"]:
-                                self.logger.info(f"[NPC-ENGINE]<confirm_conversation>: {json_data}")
-                            if "close" in json_data["func"]:
-                                self.logger.info(f"[NPC-ENGINE]<close>: {json_data}")
-                    except json.JSONDecodeError:
-                        # print the raw data and the address of the sender and the time and the traceback
-                        print(
-                            f"json decode error: {data} from {addr} at {datetime.datetime.now()}"
-                        )
-                        # print error getting key
-                        print(f"error getting key: {json_data['func']}")
-                        self.logger.error(traceback.format_exc())
-                    except KeyboardInterrupt:
-                        self.logger.info("Detected Ctrl+C, exiting...")
-                        self.sock.close()
-
-                    except Exception as e:
-                        print(f"error: {e}")
-                        self.logger.error(traceback.format_exc())
-                        pass
+        max_workers = ENGINE_CONFIG["max_workers"]
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: EngineProtocol(self), sock=self.sock
+        )
+        pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="npc-engine")
+        workers = [self.loop.create_task(self.worker(pool)) for _ in range(max_workers)]
+        try:
+            await self.closed
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.transport.close()
+            # 不在事件循环中等待正在执行的LLM请求
+            pool.shutdown(wait=False)
+            self.logger.info("engine stopped listening")
+
+    def datagram_received(self, data: bytes, addr):
+        """
+        在事件循环中被EngineProtocol回调，重组UDP分片，完整的数据包放入待处理队列
+        :param data: UDP数据包
+        :param addr: 发送方地址
+        :return:
+        """
+        try:
+            # 解析UDP数据包头部(文本头部或二进制头部)
+            msg_id, packet_no, total_packets, flags, pack = unpack_packet(data)
+            # 缓存数据包，收齐后得到完整消息
+            message = self.reassembly.add(msg_id, packet_no, total_packets, pack)
+            if message is None:
+                return
+            message = decompress_payload(message, flags, ENGINE_CONFIG["max_message_bytes"])
+            # 解码的同时校验主要数据包的必填字段
+            json_data = decode_packet(message)
+        except PacketError as e:
+            self.logger.warning(f"drop packet from {addr} at {datetime.datetime.now()}: {e}")
+            return
+        except Exception as e:
+            print(f"error: {e}")
+            self.logger.error(traceback.format_exc())
+            return
+        self.logger.debug(f"received packet {json_data}")
+
+        if "init" in json_data["func"]:
+            self.logger.info(f"[NPC-ENGINE]<UDP INIT>: {json_data}")
+        if "create_conversation" in json_data["func"]:
+            self.logger.info(f"[NPC-ENGINE]<create_conversation>: {json_data}")
+        if "confirm_conversation" in json_data["func"]:
+            self.logger.info(f"[NPC-ENGINE]<confirm_conversation>: {json_data}")
+        if "close" in json_data["func"]:
+            self.logger.info(f"[NPC-ENGINE]<close>: {json_data}")
+        priority = self.FUNC_PRIORITY.get(json_data["func"], PRIORITY_CONVERSATION)
+        coalesce = json_data["func"] in self.COALESCE_FUNCS
+        if not self.scheduler.submit(self.lane_key(json_data), json_data, priority, coalesce):
+            # socket暂停读取前已经到达的数据包，只能丢弃
+            self.logger.warning(f"packet queue is full, drop packet {json_data['func']}")
+            return
+        # 队列满了就暂停读取socket，多余的数据包留在内核缓冲区中
+        if self.scheduler.full():
+            self.pause_reading()
+
+    def lane_key(self, json_data: Dict[str, Any]):
+        """
+        决定数据包在调度器中的lane，同一个lane的数据包按顺序处理
+            wake_up/action_done/talk2npc: 按NPC名字排队，避免并发修改同一个NPC的状态和记忆
+            confirm_conversation_line/re_create_conversation: 按对话ID排队
+            其他数据包: 没有顺序要求
+        :param json_data: 数据包
+        :return: lane的名字，None表示没有顺序要求
+        """
+        if "npc_name" in json_data:
+            return "npc", json_data["npc_name"]
+        if "conversation_id" in json_data:
+            return "conversation", json_data["conversation_id"]
+        if json_data["func"] == "re_create_conversation":
+            return "conversation", json_data.get("id")
+        return None
+
+    def pause_reading(self):
+        pause = getattr(self.transport, "pause_reading", None)
+        if pause is not None and not self.reading_paused:
+            pause()
+            self.reading_paused = True
+            self.logger.warning("packet queue is full, pause reading socket")
+
+    def resume_reading(self):
+        resume = getattr(self.transport, "resume_reading", None)
+        if resume is not None and self.reading_paused:
+            resume()
+            self.reading_paused = False
+            self.logger.info("packet queue drained, resume reading socket")
+
+    async def worker(self, pool: ThreadPoolExecutor):
+        """
+        从调度器中取出数据包，按照func字段在线程池中调用相应的函数
+        :param pool: 执行处理函数的线程池
+        :return:
+        """
+        while True:
+            key, job = await self.scheduler.get()
+            json_data = job.packet
+            # 队列降到一半以下时恢复读取socket
+            if self.reading_paused and len(self.scheduler) <= self.scheduler.max_pending // 2:
+                self.resume_reading()
+            try:
+                # 被取代的wake_up没有需要保留的内容，直接跳过
+                if json_data["func"] == "wake_up" and self.scheduler.superseded(key, job):
+                    self.record_superseded(json_data, llm_calls_saved=2)
+                    continue
+                # 按照完整数据包的func字段调用相应的函数
+                func_name = json_data["func"]
+                if hasattr(self, func_name):
+                    func = getattr(self, func_name)
+                    await self.loop.run_in_executor(pool, partial(self.run_job, func, key, job))
+            except Exception as e:
+                print(f"error: {e}")
+                self.logger.error(traceback.format_exc())
+            finally:
+                self.scheduler.done(key)
+
+    def run_job(self, func, key, job):
+        """
+        在工作线程中执行处理函数，处理函数可以通过is_superseded查询数据包是否已经过时
+        """
+        self.current_job.key = key
+        self.current_job.job = job
+        try:
+            func(job.packet)
+        finally:
+            self.current_job.job = None
+
+    def is_superseded(self) -> bool:
+        """
+        当前工作线程处理的数据包，是否已经被同一个NPC之后到达的wake_up/action_done取代
+        :return:
+        """
+        job = getattr(self.current_job, "job", None)
+        return job is not None and self.scheduler.superseded(self.current_job.key, job)
+
+    def record_superseded(self, json_data: Dict[str, Any], llm_calls_saved: int):
+        """
+        记录被取代的数据包以及省下的LLM请求数
+        """
+        with self.stats_lock:
+            self.coalesce_stats["superseded"] += 1
+            self.coalesce_stats["llm_calls_saved"] += llm_calls_saved
+        self.logger.debug(f"[NPC-ENGINE]<{json_data['func']}> npc {json_data.get('npc_name')} superseded by a newer packet, "
+                          f"skip {llm_calls_saved} llm calls, stats: {self.coalesce_stats}")
 
     def batch_search_memory(self, npcs: List[str], query: str, memory_k: int):
         """
@@ -339,7 +499,9 @@ class NPCEngine:
             language=self.language,
             model=self.model,
             stream = stream,
-            sock = self.sock,
+            sock = self.send_sock,
+            framing = self.framing,
+            compression = self.compression,
             game_url = self.game_url,
             game_port = self.game_port,
             project_root = self.PROJECT_ROOT_PATH
@@ -465,6 +627,8 @@ class NPCEngine:
         "language": "E" or "C",
         # 下面是🉑️选
         "npc": [], # 可以留空，默认按照your_scene_name.json初始化场景NPC。非空则在之前基础上添加。
+        "framing": "binary", # 可以留空，默认使用文本头部；填写binary时，引擎之后发送的数据包使用二进制头部
+        "compression": "zlib", # 可以留空，默认不压缩；和binary头部一起使用时，超过compress_threshold的消息(例如长剧本)会被zlib压缩
         }
         :param json_data:
         :return:
@@ -598,7 +762,13 @@ class NPCEngine:
 
             # language
             self.language = json_data["language"]
-            self.send_data({"name": "inited", "status": "success"})
+            # 游戏端声明支持二进制头部时，inited之后的数据包都使用二进制头部
+            framing = FRAMING_BINARY if json_data.get("framing") == FRAMING_BINARY else FRAMING_TEXT
+            # 压缩标志位在二进制头部中，因此压缩只能和二进制头部一起使用
+            compression = COMPRESSION_ZLIB if framing == FRAMING_BINARY and json_data.get("compression") == COMPRESSION_ZLIB else None
+            self.send_data({"name": "inited", "status": "success", "framing": framing, "compression": compression})
+            self.framing = framing
+            self.compression = compression
         except Exception as e:
             self.logger.error(f"init error:{traceback.format_exc()}")
             self.send_data({"name": "inited", "status": "failed"})
@@ -693,8 +863,15 @@ class NPCEngine:
             npc.set_scenario(scenario_name)
             # 添加NPC记忆
             npc.memory.add_memory_text(action_log, game_time=json_data["time"])
+            # 如果这个NPC已经有更新的数据包，只保留状态和记忆，不再规划
+            if self.is_superseded():
+                self.record_superseded(json_data, llm_calls_saved=2)
+                return
             # 更新purpose
             npc.purpose = npc.get_purpose(time=json_data["time"], k=3)
+            if self.is_superseded():
+                self.record_superseded(json_data, llm_calls_saved=1)
+                return
             # 生成新的action
             new_action: Dict[str, Any] = npc.get_action(time=json_data["time"], fail_safe=self.fail_safe, k=3)
             action_packet = new_action
@@ -752,6 +929,9 @@ class NPCEngine:
             npc.set_scenario(scenario=json_data["scenario_name"])
             # 更新NPC的purpose
             npc.purpose = npc.get_purpose(time=json_data["time"], k=3)
+            if self.is_superseded():
+                self.record_superseded(json_data, llm_calls_saved=1)
+                return
             # 生成新的action
             new_action = npc.get_action(time=json_data["time"], fail_safe=self.fail_safe, k=3)
             action_packet = new_action
@@ -860,7 +1040,7 @@ class NPCEngine:
         print(
             "[NPC-ENGINE]sending script:",
             Fore.GREEN,
-            json.dumps(script).encode(),
+            script,
             Style.RESET_ALL,
             "to",
             (self.game_url, self.game_port),
@@ -874,27 +1054,9 @@ class NPCEngine:
         :param max_packet_size:
         :return:
         """
-        # UUID作为消息ID
-        msg_id = uuid.uuid4().hex
-        # 将json字符串转换为bytes
-        data = json.dumps(data).encode("utf-8")
-        # 计算数据包总数
-        packets = [
-            data[i: i + max_packet_size] for i in range(0, len(data), max_packet_size)
-        ]
-        total_packets = len(packets)
-        print(total_packets)
-
-        for i, packet in enumerate(packets):
-            # 构造UDP数据包头部
-            print(
-                "sending packet {} of {}, size: {} KB".format(
-                    i + 1, total_packets, self.calculate_str_size_in_kb(packet)
-                )
-            )
-            header = f"{msg_id}@{i + 1}@{total_packets}".encode("utf-8")
-            # 发送UDP数据包
-            self.sock.sendto(header + b"@" + packet, (self.game_url, self.game_port))
+        send_data(sock=self.send_sock, target_url=self.game_url, target_port=self.game_port,
+                  data=data, max_packet_size=max_packet_size, framing=self.framing,
+                  compression=self.compression)
 
     def calculate_str_size_in_kb(self, string: bytes):
         # 获取字符串的字节数
@@ -924,17 +1086,15 @@ class NPCEngine:
         :return:
         """
         try:
-            # 关闭socket
-            self.sock.close()
-            self.logger.debug("socket closed")
             # 保存所有NPC到本地
             self.save_npc_json()
             self.logger.info("Engine closing")
-            # 退出程序
-            sys.exit(0)
         except Exception as e:
             self.logger.error(f"[NPC-ENGINE]<close> error: {traceback.format_exc()}")
-            sys.exit(0)
+        finally:
+            # 关闭socket，listen随之结束
+            self.loop.call_soon_threadsafe(self.transport.close)
+            self.logger.debug("socket closed")
 
 if __name__ == "__main__":
     import os
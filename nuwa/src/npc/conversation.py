@@ -4,7 +4,7 @@ Author : Yangzejun
 Contact : yzj_cs_ilstar@163.com
 """
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from uuid import uuid4
 import copy
 import json
@@ -16,7 +16,7 @@ import openai
 #import zhipuai
 from colorama import Fore, Style
 from nuwa.src.utils.model_api import get_model_answer
-from nuwa.src.utils.send_utils import send_data
+from nuwa.src.utils.send_utils import send_data, FRAMING_TEXT
 
 os.environ["HTTP_PROXY"] = "http://127.0.0.1:7890"
 os.environ["HTTPS_PROXY"] = "http://127.0.0.1:7890"
@@ -68,6 +68,8 @@ class Conversation:
         language: str = "C",
         stream: bool = True,
         sock = None,
+        framing: str = FRAMING_TEXT,
+        compression: Optional[str] = None,
         game_url: str = "",
         game_port: str = "",
     ) -> None:
@@ -89,6 +91,8 @@ class Conversation:
         self.stream = stream
         # 端口相关信息
         self.engine_sock = sock
+        self.framing = framing
+        self.compression = compression
         self.game_url = game_url
         self.game_port = game_port
         # 用于阻塞控制stream对话生成
@@ -589,7 +593,8 @@ class Conversation:
         #     (self.game_url, self.game_port),
         # )
         send_data(sock = self.engine_sock, target_url = self.game_url, 
-                  target_port = self.game_port, data = script)
+                  target_port = self.game_port, data = script, framing = self.framing,
+                  compression = self.compression)
 
     def send_line(self, line):
         """
@@ -608,7 +613,8 @@ class Conversation:
         #     (self.game_url, self.game_port),
         # )
         send_data(sock = self.engine_sock, target_url = self.game_url, 
-                  target_port = self.game_port, data = line)
+                  target_port = self.game_port, data = line, framing = self.framing,
+                  compression = self.compression)
     
     # 重新设置对话的剧本生成模式，流式还是非流式
     def set_stream(self, stream):
@@ -0,0 +1,147 @@
+"""
+引擎数据包的JSON编解码
+    优先使用orjson，其次msgspec，都没有安装时使用标准库json，三者输出相同的UTF-8 JSON
+    PACKET_SCHEMAS描述游戏发送的主要数据包的必填字段和类型，decode_packet在解码时一并完成校验，
+    处理函数拿到的数据包一定包含这些字段
+"""
+import json
+from typing import Any, Dict, List, Tuple, TypedDict, get_origin, get_type_hints
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+    _ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=_ORJSON_OPTIONS)
+
+    loads = orjson.loads
+    DecodeError = orjson.JSONDecodeError
+elif msgspec is not None:
+    JSON_BACKEND = "msgspec"
+    dumps = msgspec.json.Encoder().encode
+    loads = msgspec.json.Decoder().decode
+    DecodeError = msgspec.DecodeError
+else:
+    JSON_BACKEND = "json"
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(data) -> Any:
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
+
+    DecodeError = json.JSONDecodeError
+
+
+class PacketError(ValueError):
+    """
+    数据包不是合法的JSON对象，或者缺少必填字段
+    """
+
+
+class InitPacket(TypedDict):
+    func: str
+    scene_name: str
+    language: str
+
+
+class NPCStatePacket(TypedDict):
+    func: str
+    npc_name: str
+    scenario_name: str
+    npc_state: Dict[str, Any]
+    time: str
+
+
+class WakeUpPacket(NPCStatePacket):
+    pass
+
+
+class ActionDonePacket(NPCStatePacket):
+    status: str
+    action: str
+    object: str
+    parameters: List[Any]
+    reason: str
+
+
+class Talk2NPCPacket(NPCStatePacket):
+    player_name: str
+    speech_content: str
+    items_visible: List[str]
+    state: str
+
+
+class CreateConversationPacket(TypedDict):
+    func: str
+    npc: List[str]
+    location: str
+    scenario_name: str
+    topic: str
+    npc_states: List[Dict[str, Any]]
+    starting: str
+    player_desc: str
+    memory_k: int
+    length: str
+
+
+class ConfirmConversationLinePacket(TypedDict):
+    func: str
+    conversation_id: str
+    index: int
+
+
+PACKET_SCHEMAS = {
+    "init": InitPacket,
+    "wake_up": WakeUpPacket,
+    "action_done": ActionDonePacket,
+    "talk2npc": Talk2NPCPacket,
+    "create_conversation": CreateConversationPacket,
+    "confirm_conversation_line": ConfirmConversationLinePacket,
+}
+
+
+def _compile_schema(schema) -> List[Tuple[str, type]]:
+    # 把TypedDict的注解转换为(字段名, isinstance可用的类型)，List[str]等泛型只检查容器类型
+    fields = []
+    for name, hint in get_type_hints(schema).items():
+        origin = get_origin(hint) or hint
+        fields.append((name, object if origin is Any else origin))
+    return fields
+
+
+_COMPILED_SCHEMAS = {func: _compile_schema(schema) for func, schema in PACKET_SCHEMAS.items()}
+
+
+def decode_packet(data) -> Dict[str, Any]:
+    """
+    解码游戏发送的完整消息并校验
+    :param data: 重组后的消息(bytes或memoryview)
+    :return: 数据包
+    """
+    try:
+        packet = loads(data)
+    except (DecodeError, UnicodeDecodeError) as e:
+        raise PacketError(f"invalid json: {e}") from e
+    if not isinstance(packet, dict) or not isinstance(packet.get("func"), str):
+        raise PacketError(f"packet without func field: {packet}")
+    for name, expected in _COMPILED_SCHEMAS.get(packet["func"], ()):
+        if name not in packet:
+            raise PacketError(f"{packet['func']} packet without {name} field")
+        value = packet[name]
+        # JSON中的整数可以作为float使用，但bool不能作为int使用
+        if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+            raise PacketError(f"{packet['func']} packet field {name} should be {expected.__name__}, "
+                              f"got {type(value).__name__}")
+    return packet
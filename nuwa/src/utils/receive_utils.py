@@ -0,0 +1,139 @@
+"""
+引擎接收UDP数据包时使用的工具，负责把游戏发来的分片重组为完整消息
+"""
+import logging
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from nuwa.src.utils.send_utils import FLAG_ZLIB
+
+
+class _PendingMessage:
+    """
+    一条还没有收齐分片的消息
+    """
+    __slots__ = ("parts", "received", "size", "first_seen")
+
+    def __init__(self, total_packets: int, first_seen: float):
+        self.parts: List[Optional[bytes]] = [None] * total_packets
+        self.received = 0
+        self.size = 0
+        self.first_seen = first_seen
+
+
+class ReassemblyBuffer:
+    """
+    UDP分片重组缓存
+        1.每条消息记录已收到的分片数，收齐时直接拼接，不需要每个分片都扫描整条消息
+        2.超过ttl秒仍未收齐的消息会被丢弃(分片丢失)
+        3.缓存的分片总字节数超过max_bytes时，丢弃最早的未完成消息
+    丢弃和异常的情况都会记录在stats计数中
+    """
+    def __init__(self, ttl: float = 10.0, max_bytes: int = 16 * 1024 * 1024,
+                 clock: Callable[[], float] = time.monotonic):
+        self.logger = logging.getLogger("ENGINE")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        # 按第一个分片到达的顺序排列，最早的在最前面
+        self.pending: "OrderedDict[bytes, _PendingMessage]" = OrderedDict()
+        self.total_bytes = 0
+        self.stats: Dict[str, int] = {
+            "completed": 0,  # 重组完成的消息数
+            "expired": 0,  # 超时未收齐被丢弃的消息数
+            "evicted": 0,  # 因为超过缓存上限被丢弃的消息数
+            "duplicates": 0,  # 重复收到的分片数
+            "invalid": 0,  # 头部不合法的分片数
+        }
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, msg_id: bytes, packet_no: int, total_packets: int, pack: bytes) -> Optional[bytes]:
+        """
+        缓存一个分片，如果消息的分片已经收齐，返回重组后的完整消息
+        :param msg_id: 消息ID
+        :param packet_no: 分片序号，从1开始
+        :param total_packets: 分片总数
+        :param pack: 分片内容(bytes或memoryview)
+        :return: 完整消息，未收齐时返回None
+        """
+        now = self.clock()
+        self.expire(now)
+        if not 1 <= packet_no <= total_packets:
+            self.stats["invalid"] += 1
+            return None
+        # 只有一个分片的消息不进入缓存
+        if total_packets == 1:
+            self.stats["completed"] += 1
+            return bytes(pack)
+
+        message = self.pending.get(msg_id)
+        if message is None:
+            message = _PendingMessage(total_packets, now)
+            self.pending[msg_id] = message
+        elif len(message.parts) != total_packets:
+            self.stats["invalid"] += 1
+            return None
+        if message.parts[packet_no - 1] is not None:
+            self.stats["duplicates"] += 1
+            return None
+
+        message.parts[packet_no - 1] = pack
+        message.received += 1
+        message.size += len(pack)
+        self.total_bytes += len(pack)
+        if message.received == total_packets:
+            self._discard(msg_id)
+            self.stats["completed"] += 1
+            return b"".join(message.parts)
+
+        # 超过缓存上限时，丢弃最早的未完成消息
+        while self.total_bytes > self.max_bytes and self.pending:
+            oldest_id = next(iter(self.pending))
+            self._drop(oldest_id, "evicted")
+        return None
+
+    def expire(self, now: Optional[float] = None):
+        """
+        丢弃超过ttl仍未收齐的消息
+        :param now: 当前时间，默认使用clock
+        :return:
+        """
+        now = self.clock() if now is None else now
+        while self.pending:
+            oldest_id, oldest = next(iter(self.pending.items()))
+            if now - oldest.first_seen < self.ttl:
+                break
+            self._drop(oldest_id, "expired")
+
+    def _drop(self, msg_id: bytes, reason: str):
+        message = self._discard(msg_id)
+        self.stats[reason] += 1
+        missing = [i + 1 for i, part in enumerate(message.parts) if part is None]
+        self.logger.warning(f"drop incomplete message {msg_id} ({reason}), "
+                            f"received {message.received}/{len(message.parts)}, missing packets {missing}")
+
+    def _discard(self, msg_id: bytes) -> _PendingMessage:
+        message = self.pending.pop(msg_id)
+        self.total_bytes -= message.size
+        return message
+
+
+def decompress_payload(message: bytes, flags: int, max_size: int) -> bytes:
+    """
+    按头部标志位解压完整消息
+    :param message: 重组后的完整消息
+    :param flags: 分片头部的标志位
+    :param max_size: 解压后的最大字节数，防止异常数据解压出过大的消息
+    :return: 解压后的消息
+    """
+    if not flags & FLAG_ZLIB:
+        return message
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(message, max_size)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError(f"compressed message is truncated or larger than {max_size} bytes")
+    return data
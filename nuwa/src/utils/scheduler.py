@@ -0,0 +1,177 @@
+"""
+引擎的数据包调度器
+    同一个lane(一般是同一个NPC)的数据包逐个处理，保证NPC状态和记忆不会被并发修改
+    不同lane之间没有顺序要求，由引擎的多个worker并行处理
+    数据包按延迟等级排序：玩家正在等待的请求优先，其次是对话，最后是后台的NPC行为规划
+    同一个lane中可以合并的数据包(例如wake_up/action_done)，只有最新的一个需要完整处理
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+# 延迟等级，数值越小越优先
+PRIORITY_PLAYER = 0  # 玩家正在屏幕前等待，例如talk2npc
+PRIORITY_CONVERSATION = 1  # 对话剧本的生成和确认
+PRIORITY_BACKGROUND = 2  # 后台NPC的wake_up/action_done规划
+
+
+class Job:
+    """
+    调度器中的一个数据包
+    """
+    __slots__ = ("priority", "seq", "created", "packet", "coalesce")
+
+    def __init__(self, priority: int, seq: int, created: float, packet: Any, coalesce: bool = False):
+        self.priority = priority
+        self.seq = seq
+        self.created = created
+        self.packet = packet
+        self.coalesce = coalesce
+
+    def __lt__(self, other: "Job"):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class PacketScheduler:
+    """
+    按lane排队的优先级调度器，只在事件循环线程中使用，因此不需要加锁
+        submit: 把数据包放入对应的lane
+        get: 等待一个空闲且有数据包的lane，取出其中优先级最高的数据包(同等级按到达顺序)，
+             多个lane都空闲时，优先取出队首优先级最高的lane；该lane在done之前不会再被取出
+        done: 数据包处理完毕，lane重新变为空闲
+    排队过深时，超过background_ttl秒的后台数据包会被丢弃；
+    队列满时，高优先级数据包会挤掉最老的后台数据包。
+    以coalesce方式放入的数据包，会被同一个lane中之后放入的coalesce数据包取代(superseded)，
+    处理函数可以据此跳过已经过时的工作。
+    """
+    def __init__(self, max_pending: int, shed_depth: Optional[int] = None, background_ttl: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_pending = max_pending
+        self.shed_depth = max_pending // 2 if shed_depth is None else shed_depth
+        self.background_ttl = background_ttl
+        self.clock = clock
+        self.lanes: Dict[Hashable, List[Job]] = {}  # 每个lane是一个按(优先级, 到达顺序)排列的堆
+        self.active: Set[Hashable] = set()  # 正在处理数据包的lane
+        self.queued: Dict[Hashable, int] = {}  # 在ready中排队的空闲lane及其排队时的优先级
+        self.latest: Dict[Hashable, int] = {}  # 每个lane最新的coalesce数据包的序号
+        self.ready: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.pending = 0
+        self.stats: Dict[str, int] = {
+            "shed": 0,  # 因为排队过深被丢弃的后台数据包数
+        }
+        self._seq = itertools.count()
+        self._unordered = itertools.count()
+
+    def __len__(self):
+        return self.pending
+
+    def full(self) -> bool:
+        return self.pending >= self.max_pending
+
+    def submit(self, key: Optional[Hashable], packet: Any, priority: int = PRIORITY_BACKGROUND,
+               coalesce: bool = False) -> bool:
+        """
+        放入一个数据包
+        :param key: lane的名字，None表示这个数据包和其他数据包都没有顺序要求
+        :param packet: 数据包
+        :param priority: 延迟等级
+        :param coalesce: 是否取代同一个lane中之前的coalesce数据包
+        :return: 等待的数据包已满时返回False，数据包没有被放入
+        """
+        if self.full() and not (priority < PRIORITY_BACKGROUND and self._shed_oldest_background()):
+            return False
+        if key is None:
+            key = ("unordered", next(self._unordered))
+        lane = self.lanes.setdefault(key, [])
+        job = Job(priority, next(self._seq), self.clock(), packet, coalesce)
+        heapq.heappush(lane, job)
+        if coalesce:
+            self.latest[key] = job.seq
+        self.pending += 1
+        self._enqueue(key)
+        return True
+
+    async def get(self) -> Tuple[Hashable, Job]:
+        """
+        取出下一个可以处理的数据包
+        :return: (lane的名字, Job)
+        """
+        while True:
+            priority, _, key = await self.ready.get()
+            # lane被重新排队后，旧的排队记录作废
+            if self.queued.get(key) != priority or key in self.active:
+                continue
+            del self.queued[key]
+            lane = self.lanes[key]
+            job = heapq.heappop(lane)
+            stale = self._is_stale(job)
+            self.pending -= 1
+            if stale:
+                self.stats["shed"] += 1
+                self._release(key)
+                continue
+            self.active.add(key)
+            return key, job
+
+    def done(self, key: Hashable):
+        """
+        lane中的数据包处理完毕，如果lane中还有数据包就重新排队
+        :param key: lane的名字
+        :return:
+        """
+        self.active.discard(key)
+        self._release(key)
+
+    def superseded(self, key: Hashable, job: Job) -> bool:
+        """
+        job之后是否有同一个lane的coalesce数据包被放入，可以在处理函数所在的线程中调用
+        :param key: lane的名字
+        :param job: 正在处理或等待处理的数据包
+        :return:
+        """
+        return job.coalesce and self.latest.get(key, job.seq) != job.seq
+
+    def _enqueue(self, key: Hashable):
+        # lane空闲时，按照它优先级最高的数据包排队；有更高优先级的数据包到达时重新排队
+        if key in self.active:
+            return
+        priority = self.lanes[key][0].priority
+        if key not in self.queued or priority < self.queued[key]:
+            self.queued[key] = priority
+            self.ready.put_nowait((priority, next(self._seq), key))
+
+    def _release(self, key: Hashable):
+        if self.lanes.get(key):
+            self._enqueue(key)
+        elif key not in self.active:
+            self.lanes.pop(key, None)
+            self.latest.pop(key, None)
+
+    def _is_stale(self, job: Job) -> bool:
+        return (job.priority >= PRIORITY_BACKGROUND and self.pending >= self.shed_depth
+                and self.clock() - job.created > self.background_ttl)
+
+    def _shed_oldest_background(self) -> bool:
+        """
+        丢弃最老的后台数据包，为高优先级数据包腾出位置
+        :return: 是否丢弃了数据包
+        """
+        oldest_key, oldest_job = None, None
+        for key, lane in self.lanes.items():
+            for job in lane:
+                if job.priority >= PRIORITY_BACKGROUND and (oldest_job is None or job.created < oldest_job.created):
+                    oldest_key, oldest_job = key, job
+        if oldest_job is None:
+            return False
+        lane = self.lanes[oldest_key]
+        lane.remove(oldest_job)
+        heapq.heapify(lane)
+        self.pending -= 1
+        self.stats["shed"] += 1
+        if not lane and oldest_key not in self.active:
+            self.lanes.pop(oldest_key)
+            self.queued.pop(oldest_key, None)
+            self.latest.pop(oldest_key, None)
+        return True
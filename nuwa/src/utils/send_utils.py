@@ -2,11 +2,108 @@
 Filename: send_utils.py
 Author: Mengshi, Yangzejun
 Contact: ..., yzj_cs_ilstar@163.com
+
+引擎与游戏之间UDP数据包的分片格式
+    文本头部(默认)：{msg_id}@{i + 1}@{total_packets}@{json_data}
+    二进制头部(init时协商)：固定24字节的struct头部 + json_data
+        magic(2字节 b"\\xa7N") | version(1字节) | flags(1字节) | msg_id(16字节uuid) | index(uint16, 从1开始) | count(uint16)
+    二进制头部以非UTF-8起始字节开头，接收端可以和文本头部区分开，两种格式总是都能被接收。
+    flags的FLAG_ZLIB位表示json_data经过zlib压缩(只有二进制头部能携带，init时协商)，
+    超过compress_threshold字节的消息才会压缩，接收端重组完整消息后再解压。
 """
-import json
+import struct
 import uuid
+import zlib
+from typing import List, Optional, Tuple
+
+from nuwa.src.config.config import ENGINE_CONFIG
+from nuwa.src.utils.codec import dumps
+
+FRAMING_TEXT = "text"
+FRAMING_BINARY = "binary"
+
+HEADER_MAGIC = b"\xa7N"
+HEADER_VERSION = 1
+BINARY_HEADER = struct.Struct("!2sBB16sHH")
+
+COMPRESSION_ZLIB = "zlib"
+FLAG_ZLIB = 0x01
+
+
+def compress_payload(data: bytes, framing: str = FRAMING_TEXT, compression: Optional[str] = None,
+                     threshold: int = ENGINE_CONFIG["compress_threshold"]) -> Tuple[bytes, int]:
+    """
+    按协商的压缩方式压缩消息，文本头部无法携带标志位，因此不压缩
+    :param data: 完整消息
+    :param framing: 头部格式
+    :param compression: 压缩方式，None表示不压缩
+    :param threshold: 小于这个字节数的消息不压缩
+    :return: (消息, 标志位)
+    """
+    if framing != FRAMING_BINARY or compression != COMPRESSION_ZLIB or len(data) < threshold:
+        return data, 0
+    compressed = zlib.compress(data, ENGINE_CONFIG["compress_level"])
+    # 压缩后没有变小的消息(例如已经压缩过的内容)原样发送
+    if len(compressed) >= len(data):
+        return data, 0
+    return compressed, FLAG_ZLIB
+
+
+def pack_packets(data: bytes, framing: str = FRAMING_TEXT, max_packet_size: int = 6000,
+                 flags: int = 0) -> List[Tuple[bytes, memoryview]]:
+    """
+    把消息切分为UDP分片，分片内容是data的memoryview切片，不复制数据
+    :param data: 完整消息
+    :param framing: 头部格式，FRAMING_TEXT或FRAMING_BINARY
+    :param max_packet_size: 每个分片的最大长度
+    :param flags: 二进制头部的标志位
+    :return: [(头部, 分片内容), ...]
+    """
+    view = memoryview(data)
+    total_packets = max(1, -(-len(data) // max_packet_size))
+    msg_id = uuid.uuid4()
+    packets = []
+    for i in range(total_packets):
+        if framing == FRAMING_BINARY:
+            header = BINARY_HEADER.pack(HEADER_MAGIC, HEADER_VERSION, flags, msg_id.bytes, i + 1, total_packets)
+        else:
+            header = f"{msg_id.hex}@{i + 1}@{total_packets}@".encode("utf-8")
+        packets.append((header, view[i * max_packet_size: (i + 1) * max_packet_size]))
+    return packets
 
-def send_data(sock, target_url, target_port, data, max_packet_size=6000):
+
+def unpack_packet(datagram: bytes) -> Tuple[bytes, int, int, int, memoryview]:
+    """
+    解析一个UDP分片的头部，同时支持文本头部和二进制头部
+    :param datagram: UDP数据包
+    :return: (msg_id, 分片序号, 分片总数, 标志位, 分片内容)
+    """
+    if datagram[:2] == HEADER_MAGIC:
+        _, version, flags, msg_id, packet_no, total_packets = BINARY_HEADER.unpack_from(datagram)
+        if version != HEADER_VERSION:
+            raise ValueError(f"unsupported header version {version}")
+        return msg_id, packet_no, total_packets, flags, memoryview(datagram)[BINARY_HEADER.size:]
+    msg_id, packet_no, total_packets, pack = datagram.split(b"@", 3)
+    return msg_id, int(packet_no), int(total_packets), 0, memoryview(pack)
+
+
+def send_packets(sock, address, packets: List[Tuple[bytes, memoryview]]):
+    """
+    发送分片，支持sendmsg的平台上头部和内容分散写入，不需要拼接
+    :param sock:
+    :param address:
+    :param packets:
+    :return:
+    """
+    if hasattr(sock, "sendmsg"):
+        for header, payload in packets:
+            sock.sendmsg([header, payload], [], 0, address)
+    else:
+        for header, payload in packets:
+            sock.sendto(header + payload, address)
+
+
+def send_data(sock, target_url, target_port, data, max_packet_size=6000, framing=FRAMING_TEXT, compression=None):
     """
     把DICT数据发送给游戏端口
     :param sock:
@@ -14,30 +111,25 @@ def send_data(sock, target_url, target_port, data, max_packet_size=6000):
     :param target_port:
     :param data:
     :param max_packet_size:
+    :param framing: 头部格式
+    :param compression: 压缩方式
     :return:
     """
-    # UUID作为消息ID
-    msg_id = uuid.uuid4().hex
-    # 将json字符串转换为bytes
-    data = json.dumps(data).encode("utf-8")
-    # 计算数据包总数
-    packets = [
-            data[i : i + max_packet_size] for i in range(0, len(data), max_packet_size)]
+    data = dumps(data)
+    data, flags = compress_payload(data, framing=framing, compression=compression)
+    packets = pack_packets(data, framing=framing, max_packet_size=max_packet_size, flags=flags)
     total_packets = len(packets)
     print(total_packets)
-
-    for i, packet in enumerate(packets):
-        # 构造UDP数据包头部
+    for i, (_, packet) in enumerate(packets):
         print(
             "sending packet {} of {}, size: {} KB".format(
                 i + 1, total_packets, calculate_str_size_in_kb(packet)))
-        header = f"{msg_id}@{i + 1}@{total_packets}".encode("utf-8")
-        # 发送UDP数据包
-        sock.sendto(header + b"@" + packet, (target_url, target_port))
+    send_packets(sock, (target_url, target_port), packets)
+
 
 def calculate_str_size_in_kb(string: bytes):
     # 获取字符串的字节数
     byte_size = len(string)
     # 将字节数转换成KB大小
     kb_size = byte_size / 1024
-    return kb_size
\ No newline at end of file
+    return kb_size
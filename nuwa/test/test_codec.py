@@ -0,0 +1,31 @@
+import pytest
+
+from nuwa.src.utils.codec import dumps, loads, decode_packet, PacketError
+
+
+def test_dumps_and_loads_round_trip():
+    packet = {"name": "action", "npc_name": "王大妈", "parameters": ["你吃饭了没？"], "score": 0.5}
+    data = dumps(packet)
+    assert isinstance(data, bytes)
+    assert "王大妈".encode("utf-8") in data
+    assert loads(data) == packet
+    assert loads(memoryview(data)) == packet
+
+
+def test_decode_packet_validates_known_packets():
+    packet = {"func": "confirm_conversation_line", "conversation_id": "123", "index": 2}
+    assert decode_packet(dumps(packet)) == packet
+    with pytest.raises(PacketError, match="index"):
+        decode_packet(dumps({"func": "confirm_conversation_line", "conversation_id": "123"}))
+    with pytest.raises(PacketError, match="index"):
+        decode_packet(dumps({"func": "confirm_conversation_line", "conversation_id": "123", "index": "2"}))
+    with pytest.raises(PacketError, match="index"):
+        decode_packet(dumps({"func": "confirm_conversation_line", "conversation_id": "123", "index": True}))
+
+
+def test_decode_packet_rejects_malformed_packets():
+    for data in (b"not json", b"[1, 2]", b'{"no_func": 1}', b'{"func": 1}', b"\xff\xfe"):
+        with pytest.raises(PacketError):
+            decode_packet(data)
+    # 没有schema的数据包只要求func字段
+    assert decode_packet(b'{"func": "close"}') == {"func": "close"}
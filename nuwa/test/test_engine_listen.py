@@ -0,0 +1,188 @@
+"""
+引擎UDP接收链路的测试
+使用不加载模型的StubEngine在本地回环端口上运行listen，处理函数只做计时和计数
+"""
+import asyncio
+import json
+import logging
+import socket
+import threading
+import time
+import uuid
+
+import pytest
+
+from nuwa.src import engine as engine_module
+from nuwa.src.engine import NPCEngine
+from nuwa.src.utils.receive_utils import ReassemblyBuffer
+from nuwa.src.utils.scheduler import PacketScheduler
+
+
+class StubEngine(NPCEngine):
+    """
+    跳过模型和配置加载，只保留接收链路的NPCEngine
+    """
+    def __init__(self, handler_delay: float = 0.0):
+        self.logger = logging.getLogger("TEST")
+        self.engine_port = 0
+        self.npc_dict = {}
+        self.reassembly = ReassemblyBuffer()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.scheduler = PacketScheduler(max_pending=engine_module.ENGINE_CONFIG["max_pending_packets"],
+                                         background_ttl=60)
+        self.current_job = threading.local()
+        self.stats_lock = threading.Lock()
+        self.coalesce_stats = {"superseded": 0, "llm_calls_saved": 0}
+        self.reading_paused = False
+        self.closed = self.loop.create_future()
+        self.transport = None
+        self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.sock.bind(("::1", 0))
+        self.address = self.sock.getsockname()[:2]
+
+        self.handler_delay = handler_delay
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.running_npcs = []
+        self.npc_overlap = False
+        self.planned = []
+        self.handled = []
+        self.pause_count = 0
+        self.resume_count = 0
+
+    def slow(self, json_data):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.handler_delay)
+        with self.lock:
+            self.running -= 1
+            self.handled.append(json_data)
+
+    def npc_job(self, json_data):
+        with self.lock:
+            if json_data["npc_name"] in self.running_npcs:
+                self.npc_overlap = True
+            self.running_npcs.append(json_data["npc_name"])
+        self.slow(json_data)
+        with self.lock:
+            self.running_npcs.remove(json_data["npc_name"])
+
+    def action_done(self, json_data):
+        # 模拟action_done：先记录，再在没有被取代时"规划"
+        time.sleep(self.handler_delay)
+        with self.lock:
+            self.handled.append(json_data)
+            if not self.is_superseded():
+                self.planned.append(json_data["no"])
+
+    def pause_reading(self):
+        if not self.reading_paused:
+            self.pause_count += 1
+        super().pause_reading()
+
+    def resume_reading(self):
+        if self.reading_paused:
+            self.resume_count += 1
+        super().resume_reading()
+
+
+def send_packet(sock, address, data, max_packet_size=6000):
+    msg_id = uuid.uuid4().hex
+    data = json.dumps(data).encode("utf-8")
+    packets = [data[i: i + max_packet_size] for i in range(0, len(data), max_packet_size)]
+    for i, packet in enumerate(packets):
+        header = f"{msg_id}@{i + 1}@{len(packets)}".encode("utf-8")
+        sock.sendto(header + b"@" + packet, address)
+
+
+def run_engine(engine, packets, expected, timeout=10.0):
+    """
+    在后台线程中发送数据包，等待处理完expected个数据包后发送close包
+    """
+    def game():
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        time.sleep(0.1)
+        for packet in packets:
+            send_packet(sock, engine.address, packet)
+        deadline = time.time() + timeout
+        while len(engine.handled) < expected and time.time() < deadline:
+            time.sleep(0.02)
+        send_packet(sock, engine.address, {"func": "close"})
+        sock.close()
+
+    sender = threading.Thread(target=game)
+    sender.start()
+    try:
+        engine.loop.run_until_complete(asyncio.wait_for(engine.listen(), timeout))
+    finally:
+        sender.join()
+        engine.loop.close()
+
+
+def test_burst_is_bounded_by_max_workers(monkeypatch):
+    monkeypatch.setitem(engine_module.ENGINE_CONFIG, "max_workers", 4)
+    engine = StubEngine(handler_delay=0.1)
+    run_engine(engine, [{"func": "slow", "no": i} for i in range(20)], expected=20)
+    assert len(engine.handled) == 20
+    assert engine.max_running == 4
+
+
+def test_reading_pauses_and_resumes(monkeypatch):
+    monkeypatch.setitem(engine_module.ENGINE_CONFIG, "max_workers", 1)
+    monkeypatch.setitem(engine_module.ENGINE_CONFIG, "max_pending_packets", 4)
+    engine = StubEngine(handler_delay=0.05)
+    run_engine(engine, [{"func": "slow", "no": i} for i in range(12)], expected=12)
+    assert engine.pause_count >= 1
+    assert engine.resume_count >= 1
+    assert sorted(packet["no"] for packet in engine.handled) == list(range(12))
+
+
+def test_same_npc_runs_in_order_and_npcs_run_in_parallel(monkeypatch):
+    monkeypatch.setitem(engine_module.ENGINE_CONFIG, "max_workers", 4)
+    engine = StubEngine(handler_delay=0.05)
+    packets = [{"func": "npc_job", "npc_name": f"npc{i % 2}", "no": i} for i in range(10)]
+    run_engine(engine, packets, expected=10)
+    assert not engine.npc_overlap
+    assert engine.max_running == 2
+    for name in ("npc0", "npc1"):
+        order = [packet["no"] for packet in engine.handled if packet["npc_name"] == name]
+        assert order == sorted(order)
+
+
+def test_superseded_background_packets_are_coalesced(monkeypatch):
+    monkeypatch.setitem(engine_module.ENGINE_CONFIG, "max_workers", 2)
+    engine = StubEngine(handler_delay=0.1)
+    state = {"npc_name": "王大妈", "scenario_name": "李大爷家", "npc_state": {}, "time": "2021-01-01 12:00:00"}
+    action = {"status": "success", "action": "mov", "object": "李大爷家", "parameters": [], "reason": ""}
+    packets = [{"func": "action_done", "no": i, **state, **action} for i in range(3)]
+    packets.append({"func": "wake_up", "no": 3, **state})
+    packets.append({"func": "action_done", "no": 4, **state, **action})
+    run_engine(engine, packets, expected=4)
+    # 每个action_done都被处理(记录记忆)，但只有最后一个需要规划，被取代的wake_up直接跳过
+    assert sorted(packet["no"] for packet in engine.handled) == [0, 1, 2, 4]
+    assert engine.planned == [4]
+    assert engine.coalesce_stats["superseded"] == 1
+
+
+def test_multi_fragment_reassembly():
+    engine = StubEngine()
+    content = "雁栖村" * 5000  # 约45KB，会被拆分为多个分片
+    run_engine(engine, [{"func": "slow", "content": content}], expected=1)
+    assert engine.handled == [{"func": "slow", "content": content}]
+
+
+def test_bad_packets_are_dropped():
+    engine = StubEngine()
+    packets = [[1, 2], {"no_func": True}, {"func": "wake_up", "npc_name": "王大妈"}, {"func": "slow"}]
+    run_engine(engine, packets, expected=1)
+    assert engine.handled == [{"func": "slow"}]
+
+
+def test_close_packet_stops_listen():
+    engine = StubEngine()
+    run_engine(engine, [], expected=0, timeout=5.0)
+    assert engine.closed.done()
+    assert engine.transport.is_closing()
@@ -0,0 +1,59 @@
+from nuwa.src.utils.receive_utils import ReassemblyBuffer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_reassemble_out_of_order():
+    buffer = ReassemblyBuffer()
+    assert buffer.add(b"a", 2, 3, b"22") is None
+    assert buffer.add(b"a", 3, 3, b"33") is None
+    assert buffer.add(b"a", 1, 3, b"11") == b"112233"
+    assert len(buffer) == 0
+    assert buffer.total_bytes == 0
+    assert buffer.stats["completed"] == 1
+
+
+def test_single_packet_is_not_buffered():
+    buffer = ReassemblyBuffer()
+    assert buffer.add(b"a", 1, 1, b"{}") == b"{}"
+    assert len(buffer) == 0
+
+
+def test_duplicate_and_invalid_packets():
+    buffer = ReassemblyBuffer()
+    buffer.add(b"a", 1, 2, b"11")
+    assert buffer.add(b"a", 1, 2, b"11") is None
+    assert buffer.add(b"a", 3, 2, b"33") is None
+    assert buffer.add(b"a", 1, 5, b"11") is None
+    assert buffer.stats["duplicates"] == 1
+    assert buffer.stats["invalid"] == 2
+    assert buffer.add(b"a", 2, 2, b"22") == b"1122"
+
+
+def test_lost_packet_expires():
+    clock = FakeClock()
+    buffer = ReassemblyBuffer(ttl=5, clock=clock)
+    buffer.add(b"lost", 1, 2, b"11")
+    clock.now = 4
+    buffer.add(b"b", 1, 2, b"11")
+    assert len(buffer) == 2
+    clock.now = 6
+    buffer.expire()
+    assert list(buffer.pending) == [b"b"]
+    assert buffer.stats["expired"] == 1
+    assert buffer.total_bytes == 2
+
+
+def test_max_bytes_evicts_oldest():
+    buffer = ReassemblyBuffer(max_bytes=10)
+    buffer.add(b"a", 1, 2, b"x" * 6)
+    buffer.add(b"b", 1, 2, b"y" * 6)
+    assert list(buffer.pending) == [b"b"]
+    assert buffer.stats["evicted"] == 1
+    assert buffer.total_bytes == 6
@@ -0,0 +1,128 @@
+import asyncio
+
+from nuwa.src.utils.scheduler import PacketScheduler, PRIORITY_PLAYER, PRIORITY_CONVERSATION, PRIORITY_BACKGROUND
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+def test_lane_is_blocked_until_done():
+    async def scenario():
+        scheduler = PacketScheduler(max_pending=10)
+        scheduler.submit("a", 1)
+        scheduler.submit("a", 2)
+        scheduler.submit("b", 3)
+        first = await scheduler.get()
+        second = await scheduler.get()
+        # lane a正在处理，它的第二个数据包要等done之后才能取出
+        assert scheduler.ready.empty()
+        scheduler.done("a")
+        third = await scheduler.get()
+        return [(key, job.packet) for key, job in (first, second, third)]
+
+    assert run(scenario()) == [("a", 1), ("b", 3), ("a", 2)]
+
+
+def test_unordered_packets_get_own_lane():
+    async def scenario():
+        scheduler = PacketScheduler(max_pending=10)
+        scheduler.submit(None, 1)
+        scheduler.submit(None, 2)
+        return [(await scheduler.get())[1].packet, (await scheduler.get())[1].packet]
+
+    assert run(scenario()) == [1, 2]
+
+
+def test_submit_fails_when_full():
+    scheduler = PacketScheduler(max_pending=2)
+    assert scheduler.submit("a", 1)
+    assert scheduler.submit("b", 2)
+    assert scheduler.full()
+    assert not scheduler.submit("c", 3)
+    assert len(scheduler) == 2
+
+
+def test_player_packets_go_first():
+    async def scenario():
+        scheduler = PacketScheduler(max_pending=10)
+        scheduler.submit("a", "wake_up", PRIORITY_BACKGROUND)
+        scheduler.submit("b", "create_conversation", PRIORITY_CONVERSATION)
+        scheduler.submit("c", "talk2npc", PRIORITY_PLAYER)
+        return [(await scheduler.get())[1].packet for _ in range(3)]
+
+    assert run(scenario()) == ["talk2npc", "create_conversation", "wake_up"]
+
+
+def test_player_packet_overtakes_queued_background_of_same_npc():
+    async def scenario():
+        scheduler = PacketScheduler(max_pending=10)
+        scheduler.submit("a", "action_done_1", PRIORITY_BACKGROUND)
+        scheduler.submit("a", "action_done_2", PRIORITY_BACKGROUND)
+        first = (await scheduler.get())[1].packet
+        scheduler.submit("a", "talk2npc", PRIORITY_PLAYER)
+        scheduler.done("a")
+        second = (await scheduler.get())[1].packet
+        scheduler.done("a")
+        third = (await scheduler.get())[1].packet
+        return [first, second, third]
+
+    assert run(scenario()) == ["action_done_1", "talk2npc", "action_done_2"]
+
+
+def test_stale_background_is_shed_when_deep():
+    clock = FakeClock()
+
+    async def scenario():
+        scheduler = PacketScheduler(max_pending=10, shed_depth=2, background_ttl=5, clock=clock)
+        scheduler.submit("a", "old", PRIORITY_BACKGROUND)
+        clock.now = 10
+        scheduler.submit("b", "new", PRIORITY_BACKGROUND)
+        scheduler.submit("c", "talk", PRIORITY_PLAYER)
+        got = [(await scheduler.get())[1].packet, (await scheduler.get())[1].packet]
+        return got, scheduler
+
+    got, scheduler = run(scenario())
+    assert got == ["talk", "new"]
+    assert scheduler.stats["shed"] == 1
+    assert len(scheduler) == 0
+
+
+def test_full_queue_sheds_background_for_player():
+    scheduler = PacketScheduler(max_pending=2)
+    scheduler.submit("a", "wake_up", PRIORITY_BACKGROUND)
+    scheduler.submit("b", "create_conversation", PRIORITY_CONVERSATION)
+    assert not scheduler.submit("c", "wake_up", PRIORITY_BACKGROUND)
+    assert scheduler.submit("d", "talk2npc", PRIORITY_PLAYER)
+    assert scheduler.stats["shed"] == 1
+    assert "a" not in scheduler.lanes
+
+
+def test_coalesce_marks_older_packets_superseded():
+    async def scenario():
+        scheduler = PacketScheduler(max_pending=10)
+        scheduler.submit("a", "action_done_1", coalesce=True)
+        key, running = await scheduler.get()
+        assert not scheduler.superseded(key, running)
+        scheduler.submit("a", "talk2npc", PRIORITY_PLAYER)
+        assert not scheduler.superseded(key, running)
+        scheduler.submit("a", "action_done_2", coalesce=True)
+        scheduler.submit("a", "action_done_3", coalesce=True)
+        assert scheduler.superseded(key, running)
+        scheduler.done("a")
+        result = []
+        for _ in range(3):
+            key, job = await scheduler.get()
+            result.append((job.packet, scheduler.superseded(key, job)))
+            scheduler.done(key)
+        return result
+
+    assert run(scenario()) == [("talk2npc", False), ("action_done_2", True), ("action_done_3", False)]
@@ -0,0 +1,75 @@
+import json
+import socket
+import zlib
+
+import pytest
+
+from nuwa.src.utils.receive_utils import ReassemblyBuffer, decompress_payload
+from nuwa.src.utils.send_utils import (pack_packets, unpack_packet, send_data, compress_payload, BINARY_HEADER,
+                                       FRAMING_TEXT, FRAMING_BINARY, COMPRESSION_ZLIB, FLAG_ZLIB)
+
+
+def reassemble(datagrams):
+    buffer = ReassemblyBuffer()
+    messages = []
+    for datagram in datagrams:
+        msg_id, packet_no, total_packets, _, pack = unpack_packet(datagram)
+        message = buffer.add(msg_id, packet_no, total_packets, pack)
+        if message is not None:
+            messages.append(message)
+    return messages
+
+
+def test_text_header_is_backward_compatible():
+    packets = pack_packets(b'{"a": "x@y"}', framing=FRAMING_TEXT)
+    header, payload = packets[0]
+    assert header.endswith(b"@1@1@")
+    assert len(header.split(b"@")[0]) == 32
+    assert reassemble([header + bytes(payload)]) == [b'{"a": "x@y"}']
+
+
+def test_binary_header_round_trip():
+    data = ("雁栖村@" * 3000).encode("utf-8")
+    packets = pack_packets(data, framing=FRAMING_BINARY, max_packet_size=1000)
+    assert len(packets) == -(-len(data) // 1000)
+    assert all(len(header) == BINARY_HEADER.size for header, _ in packets)
+    datagrams = [header + bytes(payload) for header, payload in reversed(packets)]
+    assert reassemble(datagrams) == [data]
+
+
+def test_send_data_over_socket():
+    receiver = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    receiver.bind(("::1", 0))
+    sender = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    data = {"name": "action", "parameters": "你好" * 2000}
+    url, port = receiver.getsockname()[:2]
+    for framing in (FRAMING_TEXT, FRAMING_BINARY):
+        send_data(sender, url, port, data, max_packet_size=1000, framing=framing)
+        datagrams = [receiver.recvfrom(65536)[0] for _ in range(-(-len(json.dumps(data)) // 1000))]
+        assert [json.loads(message) for message in reassemble(datagrams)] == [data]
+    sender.close()
+    receiver.close()
+
+
+def test_large_messages_are_compressed_with_binary_framing():
+    data = json.dumps({"name": "conversation", "lines": ["王大妈：你好，李大爷！"] * 100}).encode("utf-8")
+    payload, flags = compress_payload(data, framing=FRAMING_BINARY, compression=COMPRESSION_ZLIB, threshold=4096)
+    assert flags == FLAG_ZLIB
+    assert len(payload) < len(data)
+    packets = pack_packets(payload, framing=FRAMING_BINARY, max_packet_size=100, flags=flags)
+    datagrams = [header + bytes(pack) for header, pack in packets]
+    assert unpack_packet(datagrams[0])[3] == FLAG_ZLIB
+    assert [decompress_payload(message, flags, 1 << 20) for message in reassemble(datagrams)] == [data]
+
+
+def test_compression_needs_binary_framing_and_threshold():
+    data = b"x" * 10000
+    assert compress_payload(data, framing=FRAMING_TEXT, compression=COMPRESSION_ZLIB) == (data, 0)
+    assert compress_payload(data[:100], framing=FRAMING_BINARY, compression=COMPRESSION_ZLIB) == (data[:100], 0)
+    assert compress_payload(data, framing=FRAMING_BINARY) == (data, 0)
+
+
+def test_decompress_rejects_oversized_messages():
+    compressed = zlib.compress(b"x" * 10000)
+    with pytest.raises(ValueError):
+        decompress_payload(compressed, FLAG_ZLIB, 1000)